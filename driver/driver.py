@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import functools
+import os
 import shutil
 import sys
 import time
+from typing import Iterable
 
 from slurm_interface import *
 
@@ -11,26 +14,42 @@ SLURM_JOB_START_TIMEOUT_SECONDS = 1200  # 20 minutes
 SLURM_JOB_STOP_TIMEOUT_SECONDS_BEFORE_CANCEL = 30
 
 
+# Bounds of the exponential backoff used when polling a condition
+WAIT_UNTIL_INITIAL_DELAY_SECONDS = 0.25
+WAIT_UNTIL_MAX_DELAY_SECONDS = 5.0
+WAIT_UNTIL_BACKOFF_FACTOR = 1.5
+
+
 def wait_until(condition, timeout_seconds: int = 10) -> bool:
-    while timeout_seconds != 0:
+    # Poll often at first so that fast transitions are caught quickly,
+    # then back off to avoid spamming SLURM during long waits
+    deadline = time.monotonic() + timeout_seconds
+    delay = WAIT_UNTIL_INITIAL_DELAY_SECONDS
+    now = time.monotonic()
+    while now < deadline:
         if condition():
             return True
-        time.sleep(1)
-        timeout_seconds -= 1
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * WAIT_UNTIL_BACKOFF_FACTOR, WAIT_UNTIL_MAX_DELAY_SECONDS)
+        now = time.monotonic()
     return False
 
 
 def update_file_timestamp(path: str) -> None:
-    if not os.path.exists(path):
-        return
-    if not os.path.isfile(path):
-        return
-    subprocess.Popen(f"touch -c -m {path} >/dev/null", shell=True)
+    # No existence check beforehand: a single syscall on both hit and miss
+    # Unlike "touch -c -m", both the access and modification times are updated
+    try:
+        os.utime(path, None)
+    except (FileNotFoundError, PermissionError):
+        pass
 
 
 def flush_system_io(path: str) -> None:
-    subprocess.Popen(f"ls -la {os.path.dirname(path)} >/dev/null",
-                     shell=True)
+    # Listing the directory forces the (NFS) client to revalidate its cache
+    try:
+        os.listdir(os.path.dirname(path))
+    except OSError:
+        pass
 
 
 def exit_system_failure(message=None) -> int:
@@ -45,18 +64,29 @@ def exit_build_failure(message=None) -> int:
     return int(os.getenv("BUILD_FAILURE_EXIT_CODE", "1"))
 
 
+_GITLAB_CI_ENV_TOKEN = "CUSTOM_ENV_"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_env_cached(key: str) -> Optional[str]:
+    # The environment of the driver does not change during its execution,
+    # so the lookups can safely be memoized
+    # Return value of the local key (if any job has overridden the global one)
+    # Otherwise, return the global value (if any)
+    local_key = f"{_GITLAB_CI_ENV_TOKEN}LOCAL_{key}"
+    global_key = f"{_GITLAB_CI_ENV_TOKEN}{key}"
+    return os.environ.get(local_key, os.environ.get(global_key))
+
+
 class GitLabJobInterface:
     @staticmethod
     def get_env(key: str, default=None) -> str:
-        gitlab_ci_env_token = "CUSTOM_ENV_"
-        # Return value of the local key (if any job has overridden the global one)
-        # Otherwise, return the global value (if any)
-        # Otherwise, return the default value is not any
-        local_key = f"{gitlab_ci_env_token}LOCAL_{key}"
-        global_key = f"{gitlab_ci_env_token}{key}"
-        return os.environ.get(local_key, os.environ.get(global_key, default))
+        # Return the default value if the variable is defined nowhere
+        value = _get_env_cached(key)
+        return default if value is None else value
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_bool_env(key: str) -> bool:
         value = GitLabJobInterface.get_env(key)
         if value is None:
@@ -68,6 +98,7 @@ class GitLabJobInterface:
         return GitLabJobInterface.get_env(key) is not None
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_job_uid() -> str:
         job_name = GitLabJobInterface.get_env("CI_PROJECT_ID")
         job_name += "__"
@@ -77,14 +108,22 @@ class GitLabJobInterface:
         return job_name
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_build_dir_path() -> str:
         return GitLabJobInterface.get_env("CI_BUILDS_DIR")
 
 
+# Path of the idle_script.sh file (next to this file location)
+IDLE_BASH_SCRIPT_FILEPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "idle_script.sh")
+
+
 class SLURMIdleJob:
     id: str
     work_dir: str
     current_execution: str = None
+    _script_path: str = None
+    _executed_path: str = None
+    _log_path: str = None
 
     def __init__(self, job_id: str, work_dir: str = None):
         self.id = job_id
@@ -96,11 +135,11 @@ class SLURMIdleJob:
             work_dir: str,
             batch_filename: str = "config.sbatch"
     ) -> Optional["SLURMIdleJob"]:
-        # Find the path of the idle_script.sh file (next to this file location)
-        idle_bash_script_filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "idle_script.sh")
+        idle_bash_script_filepath = IDLE_BASH_SCRIPT_FILEPATH
         if not os.path.isfile(idle_bash_script_filepath):
             logging.critical(f"File {idle_bash_script_filepath} does not exist")
             return None
+        # os.access checks the permissions of the calling user (not only the owner bits)
         if not os.access(idle_bash_script_filepath, os.X_OK):
             logging.critical(f"File {idle_bash_script_filepath} is not executable")
             return None
@@ -122,6 +161,9 @@ class SLURMIdleJob:
                 logging.debug(f"Content of {batch_filepath}:\n{f.read()}")
         # Execute the batch file
         job_id = SLURMInterface.sbatch(batch_filepath)
+        if job_id is None:
+            logging.critical(f"Failed to submit {batch_filepath}")
+            return None
         logging.debug(f"Submitted SLURM job with ID {job_id}")
         # Wait for the job to be created
         wait_until(lambda: SLURMInterface.exists(job_id), timeout_seconds=120)
@@ -135,23 +177,37 @@ class SLURMIdleJob:
         return SLURMIdleJob(job_id, work_dir) if job_id is not None else None
         # Try to attach to the job
 
-    def get_state(self) -> SLURMJobState:
-        return SLURMInterface.sacct(self.id).state
+    def get_state(self, fresh: bool = False) -> SLURMJobState:
+        return SLURMInterface.sacct(self.id, fresh).state
+
+    def get_live_state(self, fresh: bool = False) -> Optional[SLURMJobState]:
+        return SLURMInterface.state(self.id, fresh)
+
+    def is_running(self, fresh: bool = False) -> bool:
+        return self.get_live_state(fresh) == SLURMJobState.RUNNING
 
-    def is_running(self) -> bool:
-        return self.get_state() == SLURMJobState.RUNNING
+    def is_pending(self, fresh: bool = False) -> bool:
+        return self.get_live_state(fresh) == SLURMJobState.PENDING
 
-    def is_pending(self) -> bool:
-        return self.get_state() == SLURMJobState.PENDING
+    def wait_until_state(self, target_states: Iterable[SLURMJobState], timeout_seconds: int = 10) -> bool:
+        # Neither SLURM nor pyslurm notify state changes: poll the (cheap)
+        # controller state, the backoff keeps the amount of queries low
+        target_states = frozenset(target_states)
+        return wait_until(lambda: self.get_live_state() in target_states, timeout_seconds)
+
+    def wait_until_not_state(self, states: Iterable[SLURMJobState], timeout_seconds: int = 10) -> bool:
+        # An unknown state (job not found, unparsable state) is not one of the given states
+        states = frozenset(states)
+        return wait_until(lambda: self.get_live_state() not in states, timeout_seconds)
 
     def get_execution_script_path(self) -> str:
-        return os.path.join(self.work_dir, self.current_execution) + ".gitlab_ci_step_script"
+        return self._script_path
 
     def get_execution_executed_path(self) -> str:
-        return self.get_execution_script_path() + ".executed"
+        return self._executed_path
 
     def get_execution_logfile_path(self) -> str:
-        return self.get_execution_script_path() + ".log"
+        return self._log_path
 
     def execute_script(
             self,
@@ -159,24 +215,26 @@ class SLURMIdleJob:
             source_script_path: str = None
     ) -> Tuple[str, str]:
         self.current_execution = script_name
+        self._script_path = os.path.join(self.work_dir, script_name) + ".gitlab_ci_step_script"
+        self._executed_path = self._script_path + ".executed"
+        self._log_path = self._script_path + ".log"
         script_filepath = self.get_execution_script_path()
         script_log_filepath = self.get_execution_logfile_path()
         script_executed_filepath = self.get_execution_executed_path()
 
         script_content = ""
-        try:
-            if source_script_path is not None:
-                with open(source_script_path, "r", encoding="utf-8") as f:
-                    script_content = f.read()
-        finally:
-            tmp_script_filepath = script_filepath + ".tmp"
-            with open(tmp_script_filepath, "w", encoding="utf-8") as f:
-                f.write(script_content)
-            os.rename(tmp_script_filepath, script_filepath)
-            logging.debug(f"Created the script file: {os.path.abspath(script_filepath)}")
-            logging.info(
-                f"Logs of current phase <{script_name}> will be available "
-                f"in {os.path.abspath(script_log_filepath)}")
+        if source_script_path is not None:
+            with open(source_script_path, "r", encoding="utf-8") as f:
+                script_content = f.read()
+        # Write to a temporary file first so that the idle job never picks a partial script
+        tmp_script_filepath = script_filepath + ".tmp"
+        with open(tmp_script_filepath, "w", encoding="utf-8") as f:
+            f.write(script_content)
+        os.replace(tmp_script_filepath, script_filepath)
+        logging.debug(f"Created the script file: {os.path.abspath(script_filepath)}")
+        logging.info(
+            f"Logs of current phase <{script_name}> will be available "
+            f"in {os.path.abspath(script_log_filepath)}")
 
         return script_executed_filepath, script_log_filepath
 
@@ -191,9 +249,9 @@ class SLURMIdleJob:
             self.mark_stop()
             timeout_before_cancel = int(GitLabJobInterface.get_env(
                 "SLURM_JOB_STOP_TIMEOUT_SECONDS_BEFORE_CANCEL", SLURM_JOB_STOP_TIMEOUT_SECONDS_BEFORE_CANCEL))
-            wait_until(lambda: not self.is_running(), timeout_seconds=timeout_before_cancel)
+            self.wait_until_not_state([SLURMJobState.RUNNING], timeout_seconds=timeout_before_cancel)
         finally:
-            if self.is_running():
+            if self.is_running(fresh=True):
                 SLURMInterface.scancel(self.id)
 
     def clean_chdir(self) -> None:
@@ -261,8 +319,8 @@ class GitLabPhases:
         # Wait for the job to not be pending
         timeout_secs = int(GitLabJobInterface.get_env(
             "SLURM_JOB_START_TIMEOUT_SECONDS", SLURM_JOB_START_TIMEOUT_SECONDS))
-        wait_until(lambda: job.is_running(), timeout_secs)
-        if not job.is_running():
+        job.wait_until_state([SLURMJobState.RUNNING], timeout_secs)
+        if not job.is_running(fresh=True):
             job.mark_stop()
             SLURMInterface.scancel(job.id)
             sys.exit(exit_system_failure("Failed to wait for SLURM job to not be pending"))
@@ -284,27 +342,44 @@ class GitLabPhases:
             flush_system_io(script_executed_file)
             return job.is_running() and os.path.isfile(script_executed_file)
 
-        read_bytes = 0
-        last_read_timestamp = 0
-        # Wait for the script to be executed
-        while not wait_until(lambda: is_phase_executed(), timeout_seconds=10):
-            if not job.is_running():
-                break
-            update_file_timestamp(script_executed_file)
-            last_edit_timestamp = os.path.getmtime(script_log_file)
-            if last_edit_timestamp != last_read_timestamp:
-                last_read_timestamp = last_edit_timestamp
-                with open(script_log_file, "r", encoding="utf-8") as f:
-                    f.seek(read_bytes)
-                    print(f.read(), end="", file=sys.stderr)
-                    sys.stderr.flush()
-                    read_bytes = f.tell()
-
-        # Output the logs of the script
-        with open(script_log_file, "r", encoding="utf-8") as f:
-            f.seek(read_bytes)
-            print(f.read(), end="", file=sys.stderr)
-            sys.stderr.flush()
+        # The log file is kept open while the phase runs: its position tracks
+        # what has already been forwarded, so reading only returns new bytes
+        log_file = None
+
+        def forward_logs(reopen: bool = False) -> None:
+            nonlocal log_file
+            read_bytes = 0
+            if log_file is not None and reopen:
+                # NFS only guarantees fresh attributes (and size) at open time
+                # (close-to-open consistency), a long-lived descriptor might
+                # miss the end of the file
+                read_bytes = log_file.tell()
+                log_file.close()
+                log_file = None
+            if log_file is None:
+                try:
+                    log_file = open(script_log_file, "rb", buffering=0)
+                except FileNotFoundError:
+                    return
+                log_file.seek(read_bytes)
+            chunk = log_file.read()
+            if chunk:
+                sys.stderr.buffer.write(chunk)
+                sys.stderr.buffer.flush()
+
+        try:
+            # Wait for the script to be executed
+            while not wait_until(lambda: is_phase_executed(), timeout_seconds=10):
+                if not job.is_running():
+                    break
+                update_file_timestamp(script_executed_file)
+                forward_logs()
+
+            # Output the remaining logs of the script
+            forward_logs(reopen=True)
+        finally:
+            if log_file is not None:
+                log_file.close()
 
         if not job.is_running():
             sys.exit(exit_system_failure(f"SLURM job with ID {job.id} is not running, state is {job.get_state()}"))
@@ -336,18 +411,23 @@ class GitLabPhases:
 
     @staticmethod
     def execute(phase: str) -> None:
-        if phase == "config":
-            GitLabPhases.config()
-        elif phase == "prepare":
-            GitLabPhases.prepare()
-        elif phase == "run":
-            run_phase = sys.argv[3]
-            if run_phase == "cleanup_file_variables":
-                GitLabPhases.run_cleanup_file_variables()
-            else:
-                GitLabPhases.run()
-        elif phase == "cleanup":
-            GitLabPhases.cleanup()
+        if phase == "run":
+            _RUN_PHASES.get(sys.argv[3], GitLabPhases.run)()
+            return
+        phase_function = _PHASES.get(phase)
+        if phase_function is not None:
+            phase_function()
+
+
+# Dispatch tables of the GitLab phases (and of the "run" sub-phases)
+_PHASES = {
+    "config": GitLabPhases.config,
+    "prepare": GitLabPhases.prepare,
+    "cleanup": GitLabPhases.cleanup,
+}
+_RUN_PHASES = {
+    "cleanup_file_variables": GitLabPhases.run_cleanup_file_variables,
+}
 
 
 def main():
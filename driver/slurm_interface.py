@@ -1,30 +1,53 @@
 #!/usr/bin/env python3
 
-import enum
+import functools
 import logging
-import os
+import shutil
 import signal
 import subprocess
-from enum import Enum
+import time
+from enum import Enum, auto
 from typing import Tuple, Optional, List, Dict
 
+# pyslurm binds directly to libslurm, which avoids forking a SLURM command
+# (and parsing its output) for every query. It is optional: the SLURM
+# command line tools are used when it is not installed, or when it is a
+# legacy release (pyslurm.job() API) lacking the API used below.
+try:
+    import pyslurm
+    _HAS_PYSLURM = all(hasattr(pyslurm, x) for x in ("db", "RPCError", "Job", "JobSubmitDescription"))
+except ImportError:
+    _HAS_PYSLURM = False
+
+# Results of sacct and squeue are reused for this amount of time to avoid
+# flooding the SLURM controller and accounting database when polling the
+# state of a job
+SLURM_QUERY_CACHE_TTL_SECONDS = 2.0
+
+
+@functools.lru_cache(maxsize=None)
+def _which(program: str) -> str:
+    return shutil.which(program) or program
+
 
 def _system(
-        command: str,
-        timeout_seconds: int = 30,
-        as_shell: bool = False
+        argv: List[str],
+        timeout_seconds: int = 30
 ) -> Tuple[int, str, str]:
+    # No shell is involved: an absolute executable path and close_fds=False
+    # allow CPython to spawn the child with posix_spawn (no fork of the
+    # driver). The file descriptors opened by Python are non-inheritable so
+    # none leaks. The child inherits the environment of the driver.
     with subprocess.Popen(
-            command if as_shell else command.split(),
-            shell=as_shell,
+            [_which(argv[0])] + argv[1:],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            env=os.environ.copy()
+            close_fds=False
     ) as execution:
         execution.wait(timeout=timeout_seconds)
         stdout, stderr = [x.decode("utf-8").strip() for x in execution.communicate()]
         retcode = execution.returncode
-        logging.debug(f"Command: {command}")
+        logging.debug(f"Command: {' '.join(argv)}")
         logging.debug(f" - Return code: {retcode}")
         logging.debug(f" - Stdout: {stdout}")
         if len(stderr) > 0:
@@ -38,73 +61,86 @@ class SLURMJobState(Enum):
     on https://slurm.schedmd.com/sacct.html#SECTION_JOB-STATE-CODES
     """
 
-    BOOT_FAIL = enum.auto()
-    CANCELLED = enum.auto()
-    COMPLETED = enum.auto()
-    DEADLINE = enum.auto()
-    FAILED = enum.auto()
-    NODE_FAIL = enum.auto()
-    OUT_OF_MEMORY = enum.auto()
-    PENDING = enum.auto()
-    PREEMPTED = enum.auto()
-    RUNNING = enum.auto()
-    REQUEUED = enum.auto()
-    RESIZING = enum.auto()
-    REVOKED = enum.auto()
-    SUSPENDED = enum.auto()
-    TIMEOUT = enum.auto()
+    BOOT_FAIL = auto()
+    CANCELLED = auto()
+    COMPLETED = auto()
+    DEADLINE = auto()
+    FAILED = auto()
+    NODE_FAIL = auto()
+    OUT_OF_MEMORY = auto()
+    PENDING = auto()
+    PREEMPTED = auto()
+    RUNNING = auto()
+    REQUEUED = auto()
+    RESIZING = auto()
+    REVOKED = auto()
+    SUSPENDED = auto()
+    TIMEOUT = auto()
 
     @staticmethod
     def _get_equivalent_states() -> Dict[str, "SLURMJobState"]:
-        return dict({
-            "BOOT_FAIL": SLURMJobState.BOOT_FAIL,
-            "BF": SLURMJobState.BOOT_FAIL,
-            "CANCELLED": SLURMJobState.CANCELLED,
-            "CA": SLURMJobState.CANCELLED,
-            "COMPLETED": SLURMJobState.COMPLETED,
-            "CD": SLURMJobState.COMPLETED,
-            "DEADLINE": SLURMJobState.DEADLINE,
-            "DL": SLURMJobState.DEADLINE,
-            "FAILED": SLURMJobState.FAILED,
-            "F": SLURMJobState.FAILED,
-            "NODE_FAIL": SLURMJobState.NODE_FAIL,
-            "NF": SLURMJobState.NODE_FAIL,
-            "OUT_OF_MEMORY": SLURMJobState.OUT_OF_MEMORY,
-            "OOM": SLURMJobState.OUT_OF_MEMORY,
-            "PENDING": SLURMJobState.PENDING,
-            "PD": SLURMJobState.PENDING,
-            "PREEMPTED": SLURMJobState.PREEMPTED,
-            "PR": SLURMJobState.PREEMPTED,
-            "RUNNING": SLURMJobState.RUNNING,
-            "R": SLURMJobState.RUNNING,
-            "REQUEUED": SLURMJobState.REQUEUED,
-            "RQ": SLURMJobState.REQUEUED,
-            "RESIZING": SLURMJobState.RESIZING,
-            "RS": SLURMJobState.RESIZING,
-            "REVOKED": SLURMJobState.REVOKED,
-            "RV": SLURMJobState.REVOKED,
-            "SUSPENDED": SLURMJobState.SUSPENDED,
-            "S": SLURMJobState.SUSPENDED,
-            "TIMEOUT": SLURMJobState.TIMEOUT,
-            "TO": SLURMJobState.TIMEOUT
-        })
+        return _STATE_FROM_STR
 
     @staticmethod
     def from_string(state: str) -> Optional["SLURMJobState"]:
-        return SLURMJobState._get_equivalent_states().get(state, None)
+        return _STATE_FROM_STR.get(state, None)
 
     def to_string(self) -> str:
-        for k, v in SLURMJobState._get_equivalent_states().items():
-            if v == self:
-                return k
-        raise ValueError(f"Invalid SLURM job state: {self}")
+        try:
+            return _STATE_TO_STR[self]
+        except KeyError:
+            raise ValueError(f"Invalid SLURM job state: {self}") from None
+
+
+# Mapping of the SLURM state names (long and abbreviated) to their enum value
+_STATE_FROM_STR: Dict[str, SLURMJobState] = {
+    "BOOT_FAIL": SLURMJobState.BOOT_FAIL,
+    "BF": SLURMJobState.BOOT_FAIL,
+    "CANCELLED": SLURMJobState.CANCELLED,
+    "CA": SLURMJobState.CANCELLED,
+    "COMPLETED": SLURMJobState.COMPLETED,
+    "CD": SLURMJobState.COMPLETED,
+    "DEADLINE": SLURMJobState.DEADLINE,
+    "DL": SLURMJobState.DEADLINE,
+    "FAILED": SLURMJobState.FAILED,
+    "F": SLURMJobState.FAILED,
+    "NODE_FAIL": SLURMJobState.NODE_FAIL,
+    "NF": SLURMJobState.NODE_FAIL,
+    "OUT_OF_MEMORY": SLURMJobState.OUT_OF_MEMORY,
+    "OOM": SLURMJobState.OUT_OF_MEMORY,
+    "PENDING": SLURMJobState.PENDING,
+    "PD": SLURMJobState.PENDING,
+    "PREEMPTED": SLURMJobState.PREEMPTED,
+    "PR": SLURMJobState.PREEMPTED,
+    "RUNNING": SLURMJobState.RUNNING,
+    "R": SLURMJobState.RUNNING,
+    "REQUEUED": SLURMJobState.REQUEUED,
+    "RQ": SLURMJobState.REQUEUED,
+    "RESIZING": SLURMJobState.RESIZING,
+    "RS": SLURMJobState.RESIZING,
+    "REVOKED": SLURMJobState.REVOKED,
+    "RV": SLURMJobState.REVOKED,
+    "SUSPENDED": SLURMJobState.SUSPENDED,
+    "S": SLURMJobState.SUSPENDED,
+    "TIMEOUT": SLURMJobState.TIMEOUT,
+    "TO": SLURMJobState.TIMEOUT,
+}
+# Reverse mapping, the long name being the canonical one (always listed first)
+_STATE_TO_STR: Dict[SLURMJobState, str] = {
+    state: name for name, state in reversed(list(_STATE_FROM_STR.items()))
+}
+
+
+# Fields queried from sacct, and the matching value of its --format option
+_SACCT_VARIABLES: Tuple[str, ...] = ("JobID", "JobName", "State", "ExitCode", "Elapsed", "NTasks", "Submit", "Start",
+                                     "End", "Account", "User", "Timelimit")
+_SACCT_FORMAT = ",".join(_SACCT_VARIABLES)
 
 
 class SLURMRegisteredJobData:
     @staticmethod
-    def variables() -> List[str]:
-        return ["JobID", "JobName", "State", "ExitCode", "Elapsed", "NTasks", "Submit", "Start", "End", "Account",
-                "User", "Timelimit"]
+    def variables() -> Tuple[str, ...]:
+        return _SACCT_VARIABLES
 
     def __init__(self, raw_data: dict):
         self.id = raw_data["JobID"].split(".")[0]
@@ -121,7 +157,39 @@ class SLURMRegisteredJobData:
         self.time_limit = raw_data["Timelimit"]
 
 
+# Command line options of the SLURM job request: (attribute, option, is_flag)
+# Flags are added when the attribute is truthy, other options when it is set
+_CLI_PARAMETERS: Tuple[Tuple[str, str, bool], ...] = (
+    ("job_name", "--job-name={}", False),
+    ("nodes", "--nodes={}", False),
+    ("mem", "--mem={}", False),
+    ("mem_bind", "--mem-bind={}", False),
+    ("mem_per_cpu", "--mem-per-cpu={}", False),
+    ("cpus_per_task", "--cpus-per-task={}", False),
+    ("n_tasks", "--ntasks={}", False),
+    ("time_limit", "--time={}", False),
+    ("time_min", "--time-min={}", False),
+    ("exclusive", "--exclusive", True),
+    ("network", "--network={}", False),
+    ("contiguous", "--contiguous", True),
+    ("partition", "--partition={}", False),
+    ("power", "--power={}", False),
+    ("priority", "--priority={}", False),
+    ("nice", "--nice={}", False),
+    ("comment", "--comment=\"{}\"", False),
+    ("chdir", "--chdir={}", False),
+    ("export", "--export={}", False),
+    ("stdout_file", "--output={}", False),
+    ("stderr_file", "--error={}", False),
+)
+
+
 class SLURMJobRequestData:
+    __slots__ = (
+        "job_name", "nodes", "mem", "mem_bind", "mem_per_cpu", "cpus_per_task", "n_tasks", "time_limit",
+        "time_min", "exclusive", "network", "contiguous", "partition", "power", "priority", "nice", "comment",
+        "chdir", "export", "stdout_file", "stderr_file",
+    )
 
     def __init__(
             self,
@@ -170,30 +238,15 @@ class SLURMJobRequestData:
         self.stderr_file = stderr_file
 
     def get_cli_parameters(self) -> List[str]:
-        parameters = [
-            f"--job-name={self.job_name}",
-            f"--nodes={self.nodes}" if self.nodes is not None else None,
-            f"--mem={self.mem}" if self.mem is not None else None,
-            f"--mem-bind={self.mem_bind}" if self.mem_bind is not None else None,
-            f"--mem-per-cpu={self.mem_per_cpu}" if self.mem_per_cpu is not None else None,
-            f"--cpus-per-task={self.cpus_per_task}" if self.cpus_per_task is not None else None,
-            f"--ntasks={self.n_tasks}" if self.n_tasks is not None else None,
-            f"--time={self.time_limit}" if self.time_limit is not None else None,
-            f"--time-min={self.time_min}" if self.time_min is not None else None,
-            f"--exclusive" if self.exclusive else None,
-            f"--network={self.network}" if self.network is not None else None,
-            f"--contiguous" if self.contiguous else None,
-            f"--partition={self.partition}" if self.partition is not None else None,
-            f"--power={self.power}" if self.power is not None else None,
-            f"--priority={self.priority}" if self.priority is not None else None,
-            f"--nice={self.nice}" if self.nice is not None else None,
-            f"--comment=\"{self.comment}\"" if self.comment is not None else None,
-            f"--chdir={self.chdir}" if self.chdir is not None else None,
-            f"--export={self.export}" if self.export is not None else None,
-            f"--output={self.stdout_file}" if self.stdout_file is not None else None,
-            f"--error={self.stderr_file}" if self.stderr_file is not None else None,
-        ]
-        return [x for x in parameters if x is not None]
+        parameters = []
+        for attribute, option, is_flag in _CLI_PARAMETERS:
+            value = getattr(self, attribute)
+            if is_flag:
+                if value:
+                    parameters.append(option)
+            elif value is not None:
+                parameters.append(option.format(value))
+        return parameters
 
     def to_sbatch_file_string(self, script_lines: List[str]) -> str:
         assert len(script_lines) > 0
@@ -214,6 +267,12 @@ class SLURMJobRequestData:
         return " ".join(command)
 
 
+# Cache of the sacct results: job id -> (monotonic timestamp, job data)
+_sacct_cache: Dict[str, Tuple[float, Optional[SLURMRegisteredJobData]]] = {}
+# Cache of the squeue results: job id -> (monotonic timestamp, state)
+_squeue_cache: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
 class SLURMInterface:
 
     @staticmethod
@@ -223,33 +282,95 @@ class SLURMInterface:
         :param job_name:  The job name
         :return:          The job id or None if no job with the given name exists
         """
+        if _HAS_PYSLURM:
+            return SLURMInterface._pyslurm_get_id_from_name(job_name)
         retcode, stdout, _ = _system(
-            f"sacct --name \"{job_name}\" --noheader -P --format=JobID,JobName,Submit")
+            ["sacct", "--name", job_name, "--noheader", "-P", "--format=JobID,JobName,Submit"])
         if retcode != 0:
             return None
         stdout_lines = stdout.split("\n")
-        if len(stdout_lines) == 0:
-            return None
-        # Filter lines that do not match the job name
-        stdout_lines = [x for x in stdout_lines if job_name in x.strip().split("|")[1]]
-        if len(stdout_lines) == 0:
+        # Parse each line once into (JobID, JobName, Submit)
+        jobs = [x.strip().split("|") for x in stdout_lines if len(x.strip()) > 0]
+        # Filter jobs that do not match the job name (job steps are named differently)
+        jobs = [x for x in jobs if len(x) >= 3 and x[1] == job_name]
+        if len(jobs) == 0:
             return None
         # Find the newest job, format of the date is YYYY-MM-DDTHH:MM:SS
-        newest_job = max(stdout_lines, key=lambda x: x.strip().split("|")[2])
-        return newest_job.strip().split("|", 1)[0]
+        newest_job = max(jobs, key=lambda x: x[2])
+        return newest_job[0]
 
     @staticmethod
-    def sacct(job_id: str) -> Optional[SLURMRegisteredJobData]:
-        variables = SLURMRegisteredJobData.variables()
-        retcode, stdout, _ = _system(
-            f"sacct --jobs {job_id} --noheader -P --format={','.join(variables)}")
+    def sacct(job_id: str, fresh: bool = False) -> Optional[SLURMRegisteredJobData]:
+        """
+        Returns the accounting data of a job, reusing a recent result if any
+        :param job_id:  The job id
+        :param fresh:   Whether to bypass the cache and query SLURM again
+        :return:        The job data or None if the job does not exist
+        """
+        now = time.monotonic()
+        cached = _sacct_cache.get(job_id)
+        if not fresh and cached is not None and now - cached[0] < SLURM_QUERY_CACHE_TTL_SECONDS:
+            return cached[1]
+        job_data = SLURMInterface._sacct(job_id)
+        _sacct_cache[job_id] = (now, job_data)
+        return job_data
+
+    @staticmethod
+    def _sacct(job_id: str) -> Optional[SLURMRegisteredJobData]:
+        if _HAS_PYSLURM:
+            return SLURMInterface._pyslurm_sacct(job_id)
+        retcode, stdout, _ = _system(["sacct", "--jobs", job_id, "--noheader", "-P", f"--format={_SACCT_FORMAT}"])
         if retcode != 0 or len(stdout) == 0:
             return None
         stdout_lines = stdout.split("\n", 1)
         if len(stdout_lines) == 0:
             return None
         job_variables = stdout_lines[0].strip().split("|")
-        return SLURMRegisteredJobData(dict(zip(variables, job_variables)))
+        return SLURMRegisteredJobData(dict(zip(_SACCT_VARIABLES, job_variables)))
+
+    @staticmethod
+    def squeue_state(job_id: str, fresh: bool = False) -> Optional[str]:
+        """
+        Returns the state of a job from the SLURM controller, which is much
+        cheaper to query than the accounting database used by sacct
+        :param job_id:  The job id
+        :param fresh:   Whether to bypass the cache and query SLURM again
+        :return:        The state or None if the job is not in the queue anymore
+        """
+        now = time.monotonic()
+        cached = _squeue_cache.get(job_id)
+        if not fresh and cached is not None and now - cached[0] < SLURM_QUERY_CACHE_TTL_SECONDS:
+            return cached[1]
+        state = SLURMInterface._squeue_state(job_id)
+        _squeue_cache[job_id] = (now, state)
+        return state
+
+    @staticmethod
+    def _squeue_state(job_id: str) -> Optional[str]:
+        if _HAS_PYSLURM:
+            return SLURMInterface._pyslurm_squeue_state(job_id)
+        retcode, stdout, _ = _system(["squeue", "-j", job_id, "-h", "-o", "%T"])
+        if retcode != 0 or len(stdout) == 0:
+            return None
+        return stdout.split("\n", 1)[0].strip()
+
+    @staticmethod
+    def state(job_id: str, fresh: bool = False) -> Optional[SLURMJobState]:
+        """
+        Returns the current state of a job, asking the controller first
+        :param job_id:  The job id
+        :param fresh:   Whether to bypass the cache and query SLURM again
+        :return:        The state or None if the job does not exist
+        """
+        # sacct is only needed once the job left the queue (or is in
+        # a transient state, e.g. COMPLETING, not known by SLURMJobState)
+        state = SLURMInterface.squeue_state(job_id, fresh)
+        if state is not None:
+            state = SLURMJobState.from_string(state)
+        if state is not None:
+            return state
+        job_data = SLURMInterface.sacct(job_id, fresh)
+        return job_data.state if job_data is not None else None
 
     @staticmethod
     def exists(job_id: str) -> bool:
@@ -257,12 +378,17 @@ class SLURMInterface:
 
     @staticmethod
     def scancel(job_id: str) -> bool:
-        retcode, stdout, stderr = _system(f"scancel {job_id}")
+        # The state of the job is about to change
+        _sacct_cache.pop(job_id, None)
+        _squeue_cache.pop(job_id, None)
+        if _HAS_PYSLURM:
+            return SLURMInterface._pyslurm_scancel(job_id)
+        retcode, stdout, stderr = _system(["scancel", job_id])
         return retcode == 0
 
     @staticmethod
     def skill(job_id: str, signal_no=signal.SIGKILL) -> bool:
-        retcode, _, _ = _system(f"skill {job_id} -s {signal_no.value}")
+        retcode, _, _ = _system(["skill", job_id, "-s", str(signal_no.value)])
         return retcode == 0
 
     @staticmethod
@@ -272,8 +398,67 @@ class SLURMInterface:
         :param sbatch_filepath:  The path to the sbatch file to submit
         :return:                 The job id or None if the job could not be submitted
         """
-        retcode, stdout, stderr = _system(f"sbatch --parsable {sbatch_filepath}")
+        if _HAS_PYSLURM:
+            return SLURMInterface._pyslurm_sbatch(sbatch_filepath)
+        retcode, stdout, stderr = _system(["sbatch", "--parsable", sbatch_filepath])
         if retcode != 0:
             return None
         job_id = stdout.strip().split("\n", 1)[0].split(";", 1)[0]
         return job_id
+
+    @staticmethod
+    def _pyslurm_get_id_from_name(job_name: str) -> Optional[str]:
+        try:
+            jobs = pyslurm.db.Jobs.load(pyslurm.db.JobFilter(names=[job_name]))
+        except pyslurm.RPCError as e:
+            logging.debug(f"pyslurm: failed to load jobs named {job_name}: {e}")
+            return None
+        matches = [x for x in jobs.values() if x.name == job_name]
+        if len(matches) == 0:
+            return None
+        newest_job = max(matches, key=lambda x: x.submit_time or 0)
+        return str(newest_job.id)
+
+    @staticmethod
+    def _pyslurm_sacct(job_id: str) -> Optional[SLURMRegisteredJobData]:
+        try:
+            job = pyslurm.db.Job.load(int(job_id))
+        except (pyslurm.RPCError, ValueError) as e:
+            logging.debug(f"pyslurm: failed to load job {job_id}: {e}")
+            return None
+        # Same layout as the sacct output, unset values are left empty
+        # (the number of tasks is only known by the job steps, not the job)
+        values = [job.id, job.name, job.state, job.exit_code, job.elapsed_time, None, job.submit_time,
+                  job.start_time, job.end_time, job.account, job.user_name, job.time_limit]
+        job_variables = ["" if x is None else str(x) for x in values]
+        return SLURMRegisteredJobData(dict(zip(_SACCT_VARIABLES, job_variables)))
+
+    @staticmethod
+    def _pyslurm_squeue_state(job_id: str) -> Optional[str]:
+        try:
+            job = pyslurm.Job.load(int(job_id))
+        except (pyslurm.RPCError, ValueError) as e:
+            logging.debug(f"pyslurm: failed to load job {job_id} from the queue: {e}")
+            return None
+        return job.state
+
+    @staticmethod
+    def _pyslurm_scancel(job_id: str) -> bool:
+        try:
+            pyslurm.Job(int(job_id)).cancel()
+        except (pyslurm.RPCError, ValueError) as e:
+            logging.debug(f"pyslurm: failed to cancel job {job_id}: {e}")
+            return False
+        return True
+
+    @staticmethod
+    def _pyslurm_sbatch(sbatch_filepath: str) -> Optional[str]:
+        try:
+            description = pyslurm.JobSubmitDescription(script=sbatch_filepath)
+            # Apply the #SBATCH options written in the file, as sbatch would do
+            description.load_sbatch_options()
+            job_id = description.submit()
+        except pyslurm.RPCError as e:
+            logging.debug(f"pyslurm: failed to submit {sbatch_filepath}: {e}")
+            return None
+        return str(job_id)